@@ -1,103 +1,112 @@
 import json
-import urllib.request
 import urllib.parse
-import urllib.error
-import os
-
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
-
-
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
 
+from sf_common import (
+    API_PATH,
+    SALESFORCE_ID_PATTERN,
+    check_composite_responses,
+    encoded_soql_template,
+    get_access_token,
+    salesforce_api_call,
+    salesforce_encoded_query,
+)
 
-def salesforce_api_call(method, endpoint, access_token, instance_url, data=None):
-    """Make an API call to Salesforce."""
-    url = f"{instance_url}/services/data/v59.0{endpoint}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    body = json.dumps(data).encode('utf-8') if data else None
-    req = urllib.request.Request(url, data=body, headers=headers, method=method)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            if response.status == 204:
-                return None
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Salesforce API error: {e.code} - {error_body}")
+CONTACT_URL = f'{API_PATH}/sobjects/Contact'
+CONTACT_ROLE_URL = f'{API_PATH}/sobjects/OpportunityContactRole'
 
+# Optional request parameters copied onto the Contact
+OPTIONAL_CONTACT_FIELDS = (('firstname', 'FirstName'), ('email', 'Email'))
 
-def create_contact(access_token, instance_url, contact_data):
-    """Create a new Contact in Salesforce."""
+
+def salesforce_composite(access_token, instance_url, subrequests):
+    """
+    Execute dependent subrequests in a single Composite API round-trip.
+    
+    Returns a dict of response bodies keyed by referenceId. The request is
+    all-or-none, so any failing subrequest rolls back the others. Subrequests
+    may be dicts or already-encoded JSON bytes.
+    """
+    encoded = b','.join(
+        sub if isinstance(sub, bytes) else json.dumps(sub, separators=(',', ':')).encode('utf-8')
+        for sub in subrequests
+    )
     result = salesforce_api_call(
         method='POST',
-        endpoint='/sobjects/Contact',
+        endpoint='/composite',
         access_token=access_token,
         instance_url=instance_url,
-        data=contact_data
+        raw_body=b'{"allOrNone":true,"compositeRequest":[' + encoded + b']}'
     )
-    return result.get('id')
+    
+    subresponses = result.get('compositeResponse', [])
+    check_composite_responses(subresponses)
+    
+    return {sub.get('referenceId'): sub.get('body') for sub in subresponses}
+
+
+_OPPORTUNITY_ACCOUNT_QUERY = encoded_soql_template(
+    "SELECT Id, Name, AccountId FROM Opportunity WHERE Id = '{}' LIMIT 1"
+)
 
 
 def get_opportunity_account(access_token, instance_url, opportunity_id):
-    """Get the AccountId from an Opportunity."""
-    result = salesforce_api_call(
-        method='GET',
-        endpoint=f'/sobjects/Opportunity/{opportunity_id}?fields=AccountId,Name',
-        access_token=access_token,
-        instance_url=instance_url
+    """Get the Opportunity's Name and AccountId, or None if it does not exist."""
+    result = salesforce_encoded_query(
+        access_token, instance_url,
+        _OPPORTUNITY_ACCOUNT_QUERY.format(urllib.parse.quote(opportunity_id, safe=''))
     )
-    return result.get('AccountId'), result.get('Name')
+    records = result.get('records')
+    return records[0] if records else None
+
+
+def contact_subrequest(contact_data, account_id=None):
+    """Composite subrequest to create a Contact, under the given Account if any."""
+    body = {**contact_data, 'AccountId': account_id} if account_id else contact_data
+    return {
+        'method': 'POST',
+        'referenceId': 'contact',
+        'url': CONTACT_URL,
+        'body': body
+    }
 
 
-def create_opportunity_contact_role(access_token, instance_url, opportunity_id, contact_id, is_primary=True, role=None):
-    """Create an OpportunityContactRole to link Contact to Opportunity."""
+def opportunity_contact_role_subrequest(opportunity_id, is_primary=True, role=None):
+    """Composite subrequest to link the new Contact to the Opportunity."""
+    if role is None:
+        # Opportunity IDs are validated as alphanumeric, so no JSON escaping is needed
+        return (_CONTACT_ROLE_SUBREQUEST_TEMPLATE
+                .replace(b'__OPP__', opportunity_id.encode('utf-8'))
+                .replace(b'__PRIMARY__', b'true' if is_primary else b'false'))
+    
     role_data = {
         'OpportunityId': opportunity_id,
-        'ContactId': contact_id,
+        'ContactId': '@{contact.id}',
         'IsPrimary': is_primary
     }
     
     if role:
         role_data['Role'] = role
     
-    result = salesforce_api_call(
-        method='POST',
-        endpoint='/sobjects/OpportunityContactRole',
-        access_token=access_token,
-        instance_url=instance_url,
-        data=role_data
-    )
-    return result.get('id')
+    return {
+        'method': 'POST',
+        'referenceId': 'contact_role',
+        'url': CONTACT_ROLE_URL,
+        'body': role_data
+    }
+
+
+# Pre-encoded role-less contact role subrequest; only the Opportunity ID and
+# primary flag vary per call, so they are substituted without the JSON encoder
+_CONTACT_ROLE_SUBREQUEST_TEMPLATE = json.dumps({
+    'method': 'POST',
+    'referenceId': 'contact_role',
+    'url': CONTACT_ROLE_URL,
+    'body': {
+        'OpportunityId': '__OPP__',
+        'ContactId': '@{contact.id}',
+        'IsPrimary': '__PRIMARY__'
+    }
+}, separators=(',', ':')).replace('"__PRIMARY__"', '__PRIMARY__').encode('utf-8')
 
 
 def parse_event_body(event):
@@ -112,6 +121,37 @@ def parse_event_body(event):
     return event
 
 
+def validate_contact_request(body):
+    """
+    Validate and normalize the request body in a single pass.
+    
+    Returns (opportunity_id, contact_data, is_primary, error), where error is
+    a message for a 400 response or None if the request is valid.
+    """
+    opportunity_id = body.get('opportunity_id')
+    if not opportunity_id:
+        return None, None, None, 'opportunity_id is required'
+    if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
+        return None, None, None, 'opportunity_id must be a 15 or 18 character Salesforce ID'
+    
+    lastname = body.get('lastname')
+    if not lastname:
+        return None, None, None, 'lastname is required'
+    
+    contact_data = {'LastName': lastname}
+    for param, field in OPTIONAL_CONTACT_FIELDS:
+        value = body.get(param)
+        if value:
+            contact_data[field] = value
+    
+    # Handle string "false" or "true" values
+    is_primary = body.get('primary', True)
+    if isinstance(is_primary, str):
+        is_primary = is_primary.lower() == 'true'
+    
+    return opportunity_id, contact_data, is_primary, None
+
+
 def lambda_handler(event, context):
     """
     AWS Lambda handler to create a new contact for a given opportunity.
@@ -141,67 +181,45 @@ def lambda_handler(event, context):
         # Parse event body (handles both direct invocation and Function URL)
         body = parse_event_body(event)
         
-        # Get flat input parameters
-        opportunity_id = body.get('opportunity_id')
-        firstname = body.get('firstname', '')
-        lastname = body.get('lastname', '')
-        email = body.get('email', '')
-        is_primary = body.get('primary', True)
+        # Validate and normalize input parameters
+        opportunity_id, contact_data, is_primary, error = validate_contact_request(body)
         
-        # Handle string "false" or "true" values
-        if isinstance(is_primary, str):
-            is_primary = is_primary.lower() == 'true'
-        
-        # Validate required fields
-        if not opportunity_id:
+        if error:
             return {
                 'statusCode': 400,
                 'body': json.dumps({
                     'success': False,
-                    'error': 'opportunity_id is required'
+                    'error': error
                 })
             }
         
-        if not lastname:
+        # Get access token
+        access_token, instance_url = get_access_token()
+        
+        # Get the AccountId from the Opportunity to associate the Contact
+        opp = get_opportunity_account(access_token, instance_url, opportunity_id)
+        
+        if not opp:
             return {
-                'statusCode': 400,
+                'statusCode': 404,
                 'body': json.dumps({
                     'success': False,
-                    'error': 'lastname is required'
+                    'error': f'Opportunity {opportunity_id} not found'
                 })
             }
         
-        # Build contact data
-        contact_data = {
-            'LastName': lastname
-        }
-        if firstname:
-            contact_data['FirstName'] = firstname
-        if email:
-            contact_data['Email'] = email
-        
-        # Get access token
-        access_token, instance_url = get_access_token()
-        
-        # Get the AccountId from the Opportunity to associate the Contact
-        account_id, opp_name = get_opportunity_account(access_token, instance_url, opportunity_id)
-        
-        # Add AccountId to contact data if available
-        if account_id:
-            contact_data['AccountId'] = account_id
+        opp_name = opp.get('Name')
         
-        # Create the Contact
-        contact_id = create_contact(access_token, instance_url, contact_data)
+        # Create the Contact and link it via OpportunityContactRole in one
+        # Composite API call; a Composite reference can't be left empty, so
+        # the AccountId is set from the lookup and omitted when there is none
+        responses = salesforce_composite(access_token, instance_url, [
+            contact_subrequest(contact_data, opp.get('AccountId')),
+            opportunity_contact_role_subrequest(opportunity_id, is_primary=is_primary, role=None)
+        ])
         
-        # Create OpportunityContactRole to link Contact
-        ocr_id = create_opportunity_contact_role(
-            access_token=access_token,
-            instance_url=instance_url,
-            opportunity_id=opportunity_id,
-            contact_id=contact_id,
-            is_primary=is_primary,
-            role=None
-        )
+        contact_id = responses['contact'].get('id')
+        ocr_id = responses['contact_role'].get('id')
         
         # Build response message based on primary status
         contact_type = "Primary contact" if is_primary else "Contact"
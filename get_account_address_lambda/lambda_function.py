@@ -1,109 +1,13 @@
 import json
-import urllib.request
-import urllib.parse
-import urllib.error
-import os
 
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
-
-
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
-
-
-def salesforce_query(access_token, instance_url, soql):
-    """Execute a SOQL query."""
-    encoded_query = urllib.parse.quote(soql)
-    url = f"{instance_url}/services/data/v59.0/query?q={encoded_query}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    req = urllib.request.Request(url, headers=headers, method='GET')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"SOQL query error: {e.code} - {error_body}")
-
-
-def get_opportunity_with_account(access_token, instance_url, opportunity_id):
-    """Get Opportunity with Account details including address."""
-    query = f"""
-        SELECT Id, Name, AccountId,
-               Account.Id,
-               Account.Name,
-               Account.BillingStreet,
-               Account.BillingCity,
-               Account.BillingState,
-               Account.BillingPostalCode,
-               Account.BillingCountry,
-               Account.ShippingStreet,
-               Account.ShippingCity,
-               Account.ShippingState,
-               Account.ShippingPostalCode,
-               Account.ShippingCountry,
-               Account.Phone,
-               Account.Website
-        FROM Opportunity
-        WHERE Id = '{opportunity_id}'
-    """
-    
-    result = salesforce_query(access_token, instance_url, query)
-    
-    if result.get('records'):
-        return result['records'][0]
-    return None
+from sf_common import RESPONSE_JSON_OPTIONS, SALESFORCE_ID_PATTERN, get_access_token, get_opportunity_full
 
 
 def format_address(street, city, state, postal_code, country):
     """Format address components into a readable string."""
-    parts = []
-    if street:
-        parts.append(street)
-    
-    city_state_zip = []
-    if city:
-        city_state_zip.append(city)
-    if state:
-        city_state_zip.append(state)
-    if postal_code:
-        city_state_zip.append(postal_code)
-    
-    if city_state_zip:
-        parts.append(', '.join(city_state_zip))
-    
-    if country:
-        parts.append(country)
-    
-    return '\n'.join(parts) if parts else None
+    city_state_zip = ', '.join(part for part in (city, state, postal_code) if part)
+    lines = [line for line in (street, city_state_zip, country) if line]
+    return '\n'.join(lines) if lines else None
 
 
 def parse_event_body(event):
@@ -157,11 +61,20 @@ def lambda_handler(event, context):
                 })
             }
         
+        if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'success': False,
+                    'error': 'opportunity_id must be a 15 or 18 character Salesforce ID'
+                })
+            }
+        
         # Get access token
         access_token, instance_url = get_access_token()
         
         # Get Opportunity with Account details
-        opp = get_opportunity_with_account(access_token, instance_url, opportunity_id)
+        opp = get_opportunity_full(access_token, instance_url, opportunity_id)
         
         if not opp:
             return {
@@ -236,7 +149,7 @@ def lambda_handler(event, context):
                 'billing_address_formatted': billing_formatted,
                 'shipping_address': shipping_address,
                 'shipping_address_formatted': shipping_formatted
-            }, indent=2)
+            }, **RESPONSE_JSON_OPTIONS)
         }
         
     except Exception as e:
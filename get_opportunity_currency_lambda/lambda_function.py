@@ -1,85 +1,6 @@
 import json
-import urllib.request
-import urllib.parse
-import urllib.error
-import os
-from decimal import Decimal
 
-
-def convert_floats_to_strings(obj):
-    """Recursively convert all float/Decimal values to strings for Bedrock compatibility."""
-    if isinstance(obj, dict):
-        return {key: convert_floats_to_strings(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_floats_to_strings(item) for item in obj]
-    elif isinstance(obj, (float, Decimal)):
-        return str(obj)
-    else:
-        return obj
-
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
-
-
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
-
-
-def salesforce_query(access_token, instance_url, soql):
-    """Execute a SOQL query."""
-    encoded_query = urllib.parse.quote(soql)
-    url = f"{instance_url}/services/data/v59.0/query?q={encoded_query}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    req = urllib.request.Request(url, headers=headers, method='GET')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"SOQL query error: {e.code} - {error_body}")
-
-
-def get_opportunity_currency(access_token, instance_url, opportunity_id):
-    """Get currency information for an Opportunity."""
-    query = f"""
-        SELECT Id, Name, CurrencyIsoCode, Amount
-        FROM Opportunity
-        WHERE Id = '{opportunity_id}'
-    """
-    
-    result = salesforce_query(access_token, instance_url, query)
-    
-    if result.get('records'):
-        return result['records'][0]
-    return None
+from sf_common import RESPONSE_JSON_OPTIONS, SALESFORCE_ID_PATTERN, get_access_token, get_opportunity_full
 
 
 def parse_event_body(event):
@@ -129,11 +50,20 @@ def lambda_handler(event, context):
                 })
             }
         
+        if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'success': False,
+                    'error': 'opportunity_id must be a 15 or 18 character Salesforce ID'
+                })
+            }
+        
         # Get access token
         access_token, instance_url = get_access_token()
         
         # Get Opportunity currency details
-        opp = get_opportunity_currency(access_token, instance_url, opportunity_id)
+        opp = get_opportunity_full(access_token, instance_url, opportunity_id)
         
         if not opp:
             return {
@@ -157,12 +87,11 @@ def lambda_handler(event, context):
             'amount': amount
         }
         
-        # Convert all floats to strings for Bedrock compatibility
-        response_data = convert_floats_to_strings(response_data)
-        
+        # Amount is the only float in the payload and is stringified above;
+        # any Decimal is stringified by the encoder for Bedrock compatibility
         return {
             'statusCode': 200,
-            'body': json.dumps(response_data, indent=2)
+            'body': json.dumps(response_data, default=str, **RESPONSE_JSON_OPTIONS)
         }
         
     except Exception as e:
@@ -1,94 +1,13 @@
+import functools
 import json
-import urllib.request
+import re
 import urllib.parse
-import urllib.error
-import os
-
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
-
-
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
 
+from sf_common import RESPONSE_JSON_OPTIONS, SALESFORCE_ID_PATTERN, encoded_soql_template, sf_request
 
-def salesforce_api_call(method, endpoint, access_token, instance_url, data=None):
-    """Make an API call to Salesforce."""
-    url = f"{instance_url}/services/data/v59.0{endpoint}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    body = json.dumps(data).encode('utf-8') if data else None
-    req = urllib.request.Request(url, data=body, headers=headers, method=method)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            if response.status == 204:
-                return None
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Salesforce API error: {e.code} - {error_body}")
-
-
-def get_opportunity_contact_roles(access_token, instance_url, opportunity_id):
-    """Get all Contact Roles for an Opportunity."""
-    query = f"""
-        SELECT Id, ContactId, Contact.Name, Contact.Email, Contact.Phone, 
-               Contact.Title, Role, IsPrimary 
-        FROM OpportunityContactRole 
-        WHERE OpportunityId = '{opportunity_id}'
-        ORDER BY IsPrimary DESC
-    """
-    encoded_query = urllib.parse.quote(query)
-    
-    result = salesforce_api_call(
-        method='GET',
-        endpoint=f'/query?q={encoded_query}',
-        access_token=access_token,
-        instance_url=instance_url
-    )
-    
-    contact_roles = []
-    for record in result.get('records', []):
-        contact = record.get('Contact', {}) or {}
-        contact_roles.append({
-            'id': record.get('Id'),
-            'contact_id': record.get('ContactId'),
-            'contact_name': contact.get('Name'),
-            'contact_email': contact.get('Email'),
-            'contact_phone': contact.get('Phone'),
-            'contact_title': contact.get('Title'),
-            'role': record.get('Role'),
-            'is_primary': record.get('IsPrimary')
-        })
-    
-    return contact_roles
+# Match href="..." and link text of the NetSuite Sub Link anchor
+_HREF_RE = re.compile(r'href=["\']([^"\']+)["\']')
+_TEXT_RE = re.compile(r'>([^<]+)<')
 
 
 def extract_url_from_html(html_string):
@@ -96,10 +15,19 @@ def extract_url_from_html(html_string):
     if not html_string:
         return None, None
     
-    import re
-    # Match href="..." and link text
-    href_match = re.search(r'href=["\']([^"\']+)["\']', html_string)
-    text_match = re.search(r'>([^<]+)<', html_string)
+    # Fast path for a plain <a href="URL">TEXT</a>: one partition scan per part
+    _, found, rest = html_string.partition('href=')
+    quote = rest[:1]
+    if found and quote in ('"', "'"):
+        url, closed, _ = rest[1:].partition(quote)
+        _, _, rest = html_string.partition('>')
+        text, ended, _ = rest.partition('<')
+        if url and closed and '"' not in url and "'" not in url and text and ended:
+            return url, text
+    
+    # Anything else goes through the regexes
+    href_match = _HREF_RE.search(html_string)
+    text_match = _TEXT_RE.search(html_string)
     
     url = href_match.group(1) if href_match else None
     text = text_match.group(1) if text_match else None
@@ -107,39 +35,70 @@ def extract_url_from_html(html_string):
     return url, text
 
 
-def get_opportunity_netsuite_link(access_token, instance_url, opportunity_id):
-    """Get the NetSuite Sub Link field from Opportunity."""
-    query = f"""
-        SELECT Id, Name, NetSuite_Sub_Link__c
-        FROM Opportunity 
-        WHERE Id = '{opportunity_id}'
+# Contact Role columns returned by default
+CONTACT_ROLE_FIELDS = (
+    'Id', 'ContactId', 'Contact.Name', 'Contact.Email', 'Contact.Phone',
+    'Contact.Title', 'Role', 'IsPrimary'
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _opportunity_bundle_query(contact_role_fields):
+    """Encoded bundle query for a set of Contact Role columns, built once per set."""
+    return encoded_soql_template(f"""
+        SELECT Id, Name, NetSuite_Sub_Link__c,
+               (SELECT {', '.join(contact_role_fields)}
+                FROM OpportunityContactRoles
+                ORDER BY IsPrimary DESC)
+        FROM Opportunity
+        WHERE Id = '{{}}'
+    """)
+
+
+def get_opportunity_bundle(opportunity_id, contact_role_fields=CONTACT_ROLE_FIELDS):
     """
-    encoded_query = urllib.parse.quote(query)
+    Get the Opportunity's Contact Roles and NetSuite Sub Link in one query.
     
-    try:
-        result = salesforce_api_call(
-            method='GET',
-            endpoint=f'/query?q={encoded_query}',
-            access_token=access_token,
-            instance_url=instance_url
-        )
-        
-        if result.get('records'):
-            record = result['records'][0]
-            raw_link = record.get('NetSuite_Sub_Link__c')
-            url, subscription_id = extract_url_from_html(raw_link)
-            
-            return {
-                'opportunity_id': record.get('Id'),
-                'opportunity_name': record.get('Name'),
-                'netsuite_sub_link_raw': raw_link,
-                'netsuite_sub_url': url,
-                'netsuite_subscription_id': subscription_id
-            }
-    except Exception as e:
-        raise e
+    contact_role_fields limits the Contact Role columns fetched; keys for
+    columns left out come back as None. Returns (contact_roles, opp_data);
+    opp_data is None if the Opportunity does not exist.
+    """
+    query = _opportunity_bundle_query(tuple(contact_role_fields)).format(urllib.parse.quote(opportunity_id, safe=''))
     
-    return None
+    result = sf_request('GET', '/query?q=' + query)
+    
+    if not result.get('records'):
+        return [], None
+    
+    record = result['records'][0]
+    
+    contact_roles = [
+        {
+            'id': role.get('Id'),
+            'contact_id': role.get('ContactId'),
+            'contact_name': contact.get('Name'),
+            'contact_email': contact.get('Email'),
+            'contact_phone': contact.get('Phone'),
+            'contact_title': contact.get('Title'),
+            'role': role.get('Role'),
+            'is_primary': role.get('IsPrimary')
+        }
+        for role in (record.get('OpportunityContactRoles') or {}).get('records', [])
+        for contact in (role.get('Contact') or {},)
+    ]
+    
+    raw_link = record.get('NetSuite_Sub_Link__c')
+    url, subscription_id = extract_url_from_html(raw_link)
+    
+    opp_data = {
+        'opportunity_id': record.get('Id'),
+        'opportunity_name': record.get('Name'),
+        'netsuite_sub_link_raw': raw_link,
+        'netsuite_sub_url': url,
+        'netsuite_subscription_id': subscription_id
+    }
+    
+    return contact_roles, opp_data
 
 
 def parse_event_body(event):
@@ -192,14 +151,17 @@ def lambda_handler(event, context):
                 })
             }
         
-        # Get access token
-        access_token, instance_url = get_access_token()
-        
-        # Get Contact Roles
-        contact_roles = get_opportunity_contact_roles(access_token, instance_url, opportunity_id)
+        if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'success': False,
+                    'error': 'opportunity_id must be a 15 or 18 character Salesforce ID'
+                })
+            }
         
-        # Get NetSuite Sub Link
-        opp_data = get_opportunity_netsuite_link(access_token, instance_url, opportunity_id)
+        # Get Contact Roles and NetSuite Sub Link
+        contact_roles, opp_data = get_opportunity_bundle(opportunity_id)
         
         # Format NetSuite Subscription for UI
         netsuite_url = opp_data.get('netsuite_sub_url') if opp_data else None
@@ -224,7 +186,7 @@ def lambda_handler(event, context):
                 'opportunity_name': opp_data.get('opportunity_name') if opp_data else None,
                 'contact_roles': contact_roles,
                 'netsuite_subscription': netsuite_subscription
-            }, indent=2)
+            }, **RESPONSE_JSON_OPTIONS)
         }
         
     except Exception as e:
@@ -0,0 +1,387 @@
+import gzip
+import http.client
+import json
+import urllib.parse
+import os
+import random
+import re
+import threading
+import time
+
+# Shared Salesforce client for the Lambda functions in this repo.
+# Deployed as a Lambda layer (python/sf_common.py) so module-level caches
+# (access token, keep-alive connections) live once per container.
+
+# Salesforce OAuth Configuration (from environment variables)
+SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
+CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
+CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
+TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
+API_PATH = '/services/data/v59.0'
+
+# Access token cache (persists across warm invocations of the same container)
+DEFAULT_TOKEN_TTL = 3600  # client_credentials responses usually omit expires_in
+TOKEN_REFRESH_MARGIN = 60
+_TOKEN_CACHE = {}
+_TOKEN_LOCK = threading.Lock()
+_TOKEN_REQUEST_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+# Credentials are fixed per container, so the form body is encoded once
+_TOKEN_REQUEST_BODY = urllib.parse.urlencode({
+    'grant_type': 'client_credentials',
+    'client_id': CLIENT_ID,
+    'client_secret': CLIENT_SECRET
+}).encode('utf-8')
+# /tmp survives runtime restarts within an execution environment
+TOKEN_CACHE_FILE = os.environ.get('SALESFORCE_TOKEN_CACHE_FILE', '/tmp/.sf_token')
+
+# 15 or 18 character Salesforce record ID
+SALESFORCE_ID_PATTERN = re.compile(r'[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?')
+
+# Lambda response bodies: compact JSON by default; set PRETTY_JSON for indented output
+RESPONSE_JSON_OPTIONS = {'indent': 2} if os.environ.get('PRETTY_JSON') else {'separators': (',', ':')}
+
+# Keep-alive HTTPS connections, reused across calls and warm invocations
+HTTP_TIMEOUT = 10
+MAX_IDLE_CONNECTIONS = 4
+_CONNECTION_POOL = {}
+_POOL_LOCK = threading.Lock()
+# Raised when the server has already closed an idle keep-alive connection. A
+# reset can also hit a request Salesforce is already processing, so it is only
+# treated as a stale connection for reads, which are safe to replay
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError)
+_STALE_READ_CONNECTION_ERRORS = _STALE_CONNECTION_ERRORS + (ConnectionResetError,)
+
+# Rate-limited / temporarily unavailable responses; Salesforce rejects these
+# before doing any work, so every method can be retried safely
+RETRY_STATUSES = frozenset({429, 503})
+MAX_RETRIES = int(os.environ.get('SALESFORCE_MAX_RETRIES', '3'))
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+
+
+def _get_connection(host):
+    """Take an idle connection for host from the pool, or open a new one.
+    
+    Returns (connection, reused).
+    """
+    with _POOL_LOCK:
+        idle = _CONNECTION_POOL.get(host)
+        if idle:
+            return idle.pop(), True
+    return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT), False
+
+
+def _release_connection(host, conn):
+    """Return a connection to the pool, closing it if the pool is full."""
+    with _POOL_LOCK:
+        idle = _CONNECTION_POOL.setdefault(host, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def _retry_delay(attempt, retry_after):
+    """Seconds to wait before the next retry, or None if Retry-After asks for too long."""
+    if retry_after and retry_after.isdigit():
+        delay = int(retry_after)
+        return delay if delay <= RETRY_MAX_DELAY else None
+    # Jittered exponential backoff, also used for the HTTP-date form of Retry-After
+    return min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY) + random.random() * RETRY_BASE_DELAY
+
+
+def http_request(method, url, body=None, headers=None):
+    """Send a request over a pooled keep-alive connection; returns (status, body bytes).
+    
+    429 and 503 responses are retried up to MAX_RETRIES times, honouring Retry-After.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        status, retry_after, data = _send_request(method, url, body, headers)
+        if status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        delay = _retry_delay(attempt, retry_after)
+        if delay is None:
+            break
+        time.sleep(delay)
+    return status, data
+
+
+def _send_request(method, url, body, headers):
+    """Send one request; returns (status, Retry-After header, body bytes)."""
+    parts = urllib.parse.urlsplit(url)
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    
+    stale_errors = _STALE_READ_CONNECTION_ERRORS if method in ('GET', 'HEAD') else _STALE_CONNECTION_ERRORS
+    
+    conn, reused = _get_connection(parts.netloc)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+    except stale_errors:
+        conn.close()
+        if not reused:
+            raise
+        # Salesforce dropped the idle socket; retry once on a fresh connection
+        return _send_request(method, url, body, headers)
+    except Exception:
+        conn.close()
+        raise
+    
+    # The request has been answered, so errors from here on are never replayed
+    try:
+        data = response.read()
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+    except Exception:
+        conn.close()
+        raise
+    
+    if response.will_close:
+        conn.close()
+    else:
+        _release_connection(parts.netloc, conn)
+    
+    return response.status, response.getheader('Retry-After'), data
+
+
+def _token_entry(token, instance_url, expires_at):
+    """Build a token cache entry with its ready-made API request headers."""
+    return {
+        'token': token,
+        'instance_url': instance_url,
+        'headers': {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip'
+        },
+        'expires_at': expires_at
+    }
+
+
+def _load_token_file():
+    """Read a token persisted by an earlier runtime in this execution environment."""
+    try:
+        with open(TOKEN_CACHE_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    # Anything but a token we wrote for this client is a cache miss
+    if not isinstance(saved, dict) or saved.get('client_id') != CLIENT_ID or saved.get('token_url') != TOKEN_URL:
+        return None
+    token, instance_url, expires_at = saved.get('token'), saved.get('instance_url'), saved.get('expires_at')
+    if not isinstance(token, str) or not isinstance(instance_url, str) or not isinstance(expires_at, (int, float)):
+        return None
+    return _token_entry(token, instance_url, expires_at)
+
+
+def _save_token_file(entry):
+    """Persist a token to /tmp, readable only by the function's user."""
+    try:
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'client_id': CLIENT_ID,
+                'token_url': TOKEN_URL,
+                'token': entry['token'],
+                'instance_url': entry['instance_url'],
+                'expires_at': entry['expires_at']
+            }, f)
+    except OSError:
+        pass
+
+
+def get_access_token():
+    """Authenticate with Salesforce using client_credentials flow.
+    
+    Tokens are cached at module scope so warm Lambda containers skip the
+    OAuth round-trip until the token is close to expiring, and persisted to
+    /tmp so a restarted runtime in the same environment can reuse them.
+    """
+    key = (CLIENT_ID, TOKEN_URL)
+    
+    with _TOKEN_LOCK:
+        entry = _TOKEN_CACHE.get(key)
+        if entry is None:
+            entry = _load_token_file()
+            if entry:
+                _TOKEN_CACHE[key] = entry
+        if entry and entry['expires_at'] - time.time() > TOKEN_REFRESH_MARGIN:
+            return entry['token'], entry['instance_url']
+        
+        if not CLIENT_ID or not CLIENT_SECRET:
+            # Misconfigured function: fail before spending a TLS handshake on a doomed request
+            raise Exception("SALESFORCE_CLIENT_ID and SALESFORCE_CLIENT_SECRET must be set")
+        
+        status, raw = http_request('POST', TOKEN_URL, body=_TOKEN_REQUEST_BODY, headers=_TOKEN_REQUEST_HEADERS)
+        if status >= 400:
+            raise Exception(f"Failed to get access token: {status} - {raw.decode('utf-8')}")
+        
+        result = json.loads(raw)
+        
+        token = result.get('access_token')
+        instance_url = result.get('instance_url', SALESFORCE_INSTANCE_URL)
+        ttl = int(result.get('expires_in') or DEFAULT_TOKEN_TTL)
+        
+        entry = _token_entry(token, instance_url, time.time() + ttl)
+        _TOKEN_CACHE[key] = entry
+        _save_token_file(entry)
+        return token, instance_url
+
+
+def api_headers(access_token):
+    """Return the JSON API request headers for a token, reusing the cached dict."""
+    entry = _TOKEN_CACHE.get((CLIENT_ID, TOKEN_URL))
+    if entry and entry['token'] == access_token:
+        return entry['headers']
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json',
+        'Accept-Encoding': 'gzip'
+    }
+
+
+def invalidate_access_token(stale_token):
+    """
+    Drop the cached token after it was rejected, so the next call re-authenticates.
+    
+    Nothing is dropped if the cache already holds a different token; another
+    call has refreshed it since stale_token was handed out.
+    """
+    key = (CLIENT_ID, TOKEN_URL)
+    with _TOKEN_LOCK:
+        entry = _TOKEN_CACHE.get(key)
+        if not entry or entry['token'] != stale_token:
+            return
+        del _TOKEN_CACHE[key]
+        try:
+            os.remove(TOKEN_CACHE_FILE)
+        except OSError:
+            pass
+
+
+def salesforce_api_call(method, endpoint, access_token, instance_url, data=None, retry_auth=True, raw_body=None):
+    """
+    Make an API call to Salesforce, re-authenticating once on an expired token.
+    
+    raw_body, when given, is sent as-is instead of JSON-encoding data.
+    """
+    url = instance_url + API_PATH + endpoint
+    headers = api_headers(access_token)
+    
+    if raw_body is not None:
+        body = raw_body
+    else:
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8') if data else None
+    status, raw = http_request(method, url, body=body, headers=headers)
+    
+    if status == 401 and retry_auth:
+        invalidate_access_token(access_token)
+        access_token, instance_url = get_access_token()
+        return salesforce_api_call(method, endpoint, access_token, instance_url, data,
+                                   retry_auth=False, raw_body=raw_body)
+    if status >= 400:
+        raise Exception(f"Salesforce API error: {status} - {raw.decode('utf-8')}")
+    if status == 204:
+        return None
+    return json.loads(raw)
+
+
+def check_composite_responses(subresponses):
+    """
+    Raise the error of a failed all-or-none Composite request, if any.
+    
+    Once one subrequest fails, Salesforce reports every other one as
+    PROCESSING_HALTED, so the first error that isn't is the real cause.
+    """
+    failed = [sub for sub in subresponses if sub.get('httpStatusCode', 500) >= 400]
+    if not failed:
+        return
+    
+    def halted(sub):
+        body = sub.get('body')
+        return isinstance(body, list) and any(
+            isinstance(error, dict) and error.get('errorCode') == 'PROCESSING_HALTED' for error in body
+        )
+    
+    sub = next((sub for sub in failed if not halted(sub)), failed[0])
+    raise Exception(f"Salesforce API error: {sub.get('httpStatusCode', 500)} - {json.dumps(sub.get('body'))}")
+
+
+def sf_request(method, endpoint, data=None, raw_body=None):
+    """Call the REST API with the cached access token; see salesforce_api_call."""
+    access_token, instance_url = get_access_token()
+    return salesforce_api_call(method, endpoint, access_token, instance_url, data, raw_body=raw_body)
+
+
+def salesforce_encoded_query(access_token, instance_url, encoded_query, retry_auth=True):
+    """Execute an already URL-encoded SOQL query, re-authenticating once on an expired token."""
+    url = instance_url + API_PATH + '/query?q=' + encoded_query
+    headers = api_headers(access_token)
+    
+    status, raw = http_request('GET', url, headers=headers)
+    
+    if status == 401 and retry_auth:
+        invalidate_access_token(access_token)
+        access_token, instance_url = get_access_token()
+        return salesforce_encoded_query(access_token, instance_url, encoded_query, retry_auth=False)
+    if status >= 400:
+        raise Exception(f"SOQL query error: {status} - {raw.decode('utf-8')}")
+    return json.loads(raw)
+
+
+def encoded_soql_template(soql):
+    """Collapse whitespace and URL-encode a SOQL template once, keeping its {} placeholder."""
+    return urllib.parse.quote(' '.join(soql.split())).replace('%7B%7D', '{}')
+
+
+_OPPORTUNITY_FULL_QUERY = encoded_soql_template("""
+        SELECT Id, Name, CurrencyIsoCode, Amount, AccountId,
+               Account.Id,
+               Account.Name,
+               Account.BillingStreet,
+               Account.BillingCity,
+               Account.BillingState,
+               Account.BillingPostalCode,
+               Account.BillingCountry,
+               Account.ShippingStreet,
+               Account.ShippingCity,
+               Account.ShippingState,
+               Account.ShippingPostalCode,
+               Account.ShippingCountry,
+               Account.Phone,
+               Account.Website
+        FROM Opportunity
+        WHERE Id = '{}'
+""")
+
+
+def get_opportunity_full(access_token, instance_url, opportunity_id):
+    """
+    Get an Opportunity with its currency, amount and Account details in one query.
+    
+    Returns the Opportunity record, or None if it does not exist.
+    """
+    query = _OPPORTUNITY_FULL_QUERY.format(urllib.parse.quote(opportunity_id, safe=''))
+    
+    result = salesforce_encoded_query(access_token, instance_url, query)
+    
+    if result.get('records'):
+        return result['records'][0]
+    return None
+
+
+def warm_up():
+    """Fetch the access token and open the API connection before the first invocation."""
+    _, instance_url = get_access_token()
+    if urllib.parse.urlsplit(instance_url).netloc != urllib.parse.urlsplit(TOKEN_URL).netloc:
+        http_request('HEAD', instance_url + API_PATH)
+
+
+# Warm up during the Lambda Init phase so the first invocation only pays for
+# its own Salesforce call; failures are retried by the handler as usual
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    try:
+        warm_up()
+    except Exception:
+        pass
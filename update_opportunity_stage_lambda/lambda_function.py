@@ -1,17 +1,16 @@
 import json
-import urllib.request
-import urllib.parse
-import urllib.error
-import os
+import time
 
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
+from sf_common import (
+    API_PATH,
+    RESPONSE_JSON_OPTIONS,
+    SALESFORCE_ID_PATTERN,
+    check_composite_responses,
+    sf_request,
+)
 
 # Valid Opportunity Stages
-VALID_STAGES = [
+VALID_STAGES = (
     "Pending",
     "Outreach",
     "Engaged",
@@ -20,75 +19,80 @@ VALID_STAGES = [
     "Finalizing",
     "Closed Won",
     "Closed Lost"
-]
+)
+VALID_STAGES_SET = frozenset(VALID_STAGES)
 
+# Opportunity sObject paths: relative to the API base, and in full for Composite subrequests
+OPPORTUNITY_ENDPOINT = '/sobjects/Opportunity/'
+OPPORTUNITY_FIELDS = '?fields=Id,Name,StageName'
+OPPORTUNITY_URL = API_PATH + OPPORTUNITY_ENDPOINT
 
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
-
+# Pre-encoded read-then-PATCH Composite body; the handler validates the
+# Opportunity ID as alphanumeric, so it is substituted without JSON escaping
+_STAGE_UPDATE_TEMPLATE = json.dumps({
+    'allOrNone': True,
+    'compositeRequest': [
+        {
+            'method': 'GET',
+            'referenceId': 'opportunity',
+            'url': OPPORTUNITY_URL + '__OPP__' + OPPORTUNITY_FIELDS
+        },
+        {
+            'method': 'PATCH',
+            'referenceId': 'update',
+            'url': OPPORTUNITY_URL + '@{opportunity.Id}',
+            'body': {'StageName': '__STAGE__'}
+        }
+    ]
+}, separators=(',', ':')).replace('"__STAGE__"', '__STAGE__').encode('utf-8')
+_ENCODED_STAGES = {stage: json.dumps(stage).encode('utf-8') for stage in VALID_STAGES}
 
-def salesforce_api_call(method, endpoint, access_token, instance_url, data=None):
-    """Make an API call to Salesforce."""
-    url = f"{instance_url}/services/data/v59.0{endpoint}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    body = json.dumps(data).encode('utf-8') if data else None
-    req = urllib.request.Request(url, data=body, headers=headers, method=method)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            if response.status == 204:
-                return None
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Salesforce API error: {e.code} - {error_body}")
+# Short-lived cache of current-stage reads for UIs that poll; cleared on update
+OPPORTUNITY_CACHE_TTL = 10
+_OPPORTUNITY_CACHE = {}
 
 
-def get_opportunity(access_token, instance_url, opportunity_id):
-    """Get Opportunity details."""
-    result = salesforce_api_call(
-        method='GET',
-        endpoint=f'/sobjects/Opportunity/{opportunity_id}?fields=Id,Name,StageName',
-        access_token=access_token,
-        instance_url=instance_url
-    )
+def get_opportunity(opportunity_id):
+    """Get Opportunity details, reusing a read from the last few seconds."""
+    cached = _OPPORTUNITY_CACHE.get(opportunity_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    result = sf_request('GET', OPPORTUNITY_ENDPOINT + opportunity_id + OPPORTUNITY_FIELDS)
+    if result:
+        now = time.monotonic()
+        # Every entry has the same TTL and is re-inserted at the end on refresh,
+        # so expired entries are always at the front
+        while _OPPORTUNITY_CACHE:
+            oldest = next(iter(_OPPORTUNITY_CACHE))
+            if _OPPORTUNITY_CACHE[oldest][0] > now:
+                break
+            del _OPPORTUNITY_CACHE[oldest]
+        _OPPORTUNITY_CACHE.pop(opportunity_id, None)
+        _OPPORTUNITY_CACHE[opportunity_id] = (now + OPPORTUNITY_CACHE_TTL, result)
     return result
 
 
-def update_opportunity_stage(access_token, instance_url, opportunity_id, new_stage):
-    """Update the Opportunity stage."""
-    salesforce_api_call(
-        method='PATCH',
-        endpoint=f'/sobjects/Opportunity/{opportunity_id}',
-        access_token=access_token,
-        instance_url=instance_url,
-        data={'StageName': new_stage}
-    )
-    return True
+def update_opportunity_stage(opportunity_id, new_stage):
+    """
+    Read the current Opportunity and set its stage in one Composite API round-trip.
+    
+    Returns the Opportunity as it was before the update, or None if it does not exist.
+    """
+    _OPPORTUNITY_CACHE.pop(opportunity_id, None)
+    
+    body = (_STAGE_UPDATE_TEMPLATE
+            .replace(b'__OPP__', opportunity_id.encode('utf-8'))
+            .replace(b'__STAGE__', _ENCODED_STAGES.get(new_stage) or json.dumps(new_stage).encode('utf-8')))
+    
+    result = sf_request('POST', '/composite', raw_body=body)
+    
+    responses = {sub.get('referenceId'): sub for sub in result.get('compositeResponse', [])}
+    if responses.get('opportunity', {}).get('httpStatusCode') == 404:
+        return None
+    check_composite_responses(responses.values())
+    
+    return responses['opportunity']['body']
 
 
 def parse_event_body(event):
@@ -156,50 +160,67 @@ def lambda_handler(event, context):
                 })
             }
         
-        # Get access token
-        access_token, instance_url = get_access_token()
-        
-        # Get current Opportunity details
-        opp = get_opportunity(access_token, instance_url, opportunity_id)
-        
-        if not opp:
+        if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
             return {
-                'statusCode': 404,
+                'statusCode': 400,
                 'body': json.dumps({
                     'success': False,
-                    'error': f'Opportunity {opportunity_id} not found'
+                    'error': 'opportunity_id must be a 15 or 18 character Salesforce ID'
                 })
             }
         
-        current_stage = opp.get('StageName')
-        opp_name = opp.get('Name')
+        # Validate stage value for UPDATE operation
+        if new_stage and (not isinstance(new_stage, str) or new_stage not in VALID_STAGES_SET):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'success': False,
+                    'error': f'Invalid stage: "{new_stage}"',
+                    'valid_stages': VALID_STAGES
+                })
+            }
         
         # If no stage provided, just return current stage (GET operation)
         if not new_stage:
+            opp = get_opportunity(opportunity_id)
+            
+            if not opp:
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({
+                        'success': False,
+                        'error': f'Opportunity {opportunity_id} not found'
+                    })
+                }
+            
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     'success': True,
                     'action': 'get',
                     'opportunity_id': opportunity_id,
-                    'opportunity_name': opp_name,
-                    'current_stage': current_stage,
+                    'opportunity_name': opp.get('Name'),
+                    'current_stage': opp.get('StageName'),
                     'valid_stages': VALID_STAGES
-                })
+                }, **RESPONSE_JSON_OPTIONS)
             }
         
-        # Validate stage value for UPDATE operation
-        if new_stage not in VALID_STAGES:
+        # Update the stage, reading the previous one in the same round-trip
+        opp = update_opportunity_stage(opportunity_id, new_stage)
+        
+        if not opp:
             return {
-                'statusCode': 400,
+                'statusCode': 404,
                 'body': json.dumps({
                     'success': False,
-                    'error': f'Invalid stage: "{new_stage}"',
-                    'valid_stages': VALID_STAGES
+                    'error': f'Opportunity {opportunity_id} not found'
                 })
             }
         
-        # Check if already at the target stage
+        current_stage = opp.get('StageName')
+        opp_name = opp.get('Name')
+        
+        # The PATCH left the stage unchanged if it was already at the target
         if current_stage == new_stage:
             return {
                 'statusCode': 200,
@@ -210,12 +231,9 @@ def lambda_handler(event, context):
                     'opportunity_name': opp_name,
                     'current_stage': new_stage,
                     'message': f'Opportunity is already at stage: {new_stage}'
-                })
+                }, **RESPONSE_JSON_OPTIONS)
             }
         
-        # Update the stage
-        update_opportunity_stage(access_token, instance_url, opportunity_id, new_stage)
-        
         return {
             'statusCode': 200,
             'body': json.dumps({
@@ -226,7 +244,7 @@ def lambda_handler(event, context):
                 'previous_stage': current_stage,
                 'new_stage': new_stage,
                 'message': f'Stage updated from "{current_stage}" to "{new_stage}"'
-            })
+            }, **RESPONSE_JSON_OPTIONS)
         }
         
     except Exception as e:
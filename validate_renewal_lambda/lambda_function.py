@@ -1,78 +1,141 @@
+import functools
 import json
-import urllib.request
+import re
+import time
 import urllib.parse
-import urllib.error
-import os
-
-# Salesforce OAuth Configuration (from environment variables)
-SALESFORCE_INSTANCE_URL = os.environ.get('SALESFORCE_INSTANCE_URL', 'https://nosoftware-speed-9330.my.salesforce.com')
-CLIENT_ID = os.environ.get('SALESFORCE_CLIENT_ID', '')
-CLIENT_SECRET = os.environ.get('SALESFORCE_CLIENT_SECRET', '')
-TOKEN_URL = f"{SALESFORCE_INSTANCE_URL}/services/oauth2/token"
-
-
-def get_access_token():
-    """Authenticate with Salesforce using client_credentials flow."""
-    data = urllib.parse.urlencode({
-        'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    }).encode('utf-8')
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    req = urllib.request.Request(TOKEN_URL, data=data, headers=headers, method='POST')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('access_token'), result.get('instance_url', SALESFORCE_INSTANCE_URL)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Failed to get access token: {e.code} - {error_body}")
-
-
-def salesforce_query(access_token, instance_url, soql):
-    """Execute a SOQL query."""
-    encoded_query = urllib.parse.quote(soql)
-    url = f"{instance_url}/services/data/v59.0/query?q={encoded_query}"
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
-    req = urllib.request.Request(url, headers=headers, method='GET')
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"SOQL query error: {e.code} - {error_body}")
+from dataclasses import dataclass
+
+from sf_common import (
+    API_PATH,
+    RESPONSE_JSON_OPTIONS,
+    SALESFORCE_ID_PATTERN,
+    api_headers,
+    encoded_soql_template,
+    get_access_token,
+    http_request,
+    invalidate_access_token,
+    salesforce_api_call,
+    salesforce_encoded_query,
+)
+
+# Composite Batch subrequest URLs are relative to /services/data/
+BATCH_QUERY_URL = API_PATH.removeprefix('/services/data/') + '/query?q='
 
+# Field names from the Opportunity describe, and the custom fields resolved from
+# them; metadata rarely changes, so warm containers reuse both for an hour
+# instead of re-fetching the large describe
+DESCRIBE_CACHE_TTL = 3600
+_DESCRIBE_CACHE = {}
 
-def salesforce_get(access_token, instance_url, endpoint):
-    """Make a GET request to Salesforce."""
-    url = f"{instance_url}/services/data/v59.0{endpoint}"
+# Custom fields we're looking for (with various possible naming conventions)
+CUSTOM_FIELD_MAPPINGS = {
+    'netsuite_id': ['NetSuite_ID__c', 'NetSuiteID__c', 'Netsuite_Id__c', 'NS_ID__c', 'NetSuite_Internal_ID__c'],
+    'parent_sub_id': ['Parent_Subscription_ID__c', 'Parent_Sub_ID__c', 'ParentSubscriptionId__c', 'Parent_Subscription__c'],
+    'price_reset': ['Price_Reset__c', 'Is_Price_Reset__c', 'PriceReset__c'],
+    'auto_renewed_last_term': ['Auto_Renewed_Last_Term__c', 'AutoRenewedLastTerm__c', 'Auto_Renewal_Last_Term__c'],
+    'cancelled_before_renewal': ['Cancelled_before_Renewal_Cycle__c', 'Cancelled_Before_Renewal__c', 'CancelledBeforeRenewal__c'],
+    'cancellation_notice': ['Cancellation_Notice__c', 'CancellationNotice__c', 'Cancellation_Notice_Link__c'],
+    'auto_renewal_clause': ['Auto_Renewal_Clause__c', 'AutoRenewalClause__c', 'AR_Clause__c'],
+    'prev_quote_ar_clause': ['Prev_Quote_w_AR_Clause__c', 'Previous_Quote_AR_Clause__c', 'Prev_Quote_AR__c'],
+    'o2c_processed': ['O2C_Processed__c', 'Processed_via_O2C__c', 'O2C__c'],
+    'subscription_id': ['SBQQ__RenewedContract__c', 'Subscription__c', 'Subscription_ID__c', 'CPQ_Subscription__c'],
+    'previous_quote': ['Previous_Quote__c', 'Prev_Quote__c', 'Prior_Quote__c', 'SBQQ__RenewedQuote__c'],
+}
+
+# Standard Opportunity fields we always query
+OPPORTUNITY_BASE_FIELDS = ('Id', 'Name', 'StageName', 'AccountId', 'Amount', 'CloseDate', 'Type', 'IsClosed', 'IsWon')
+OPPORTUNITY_BASE_FIELDS_CSV = ', '.join(OPPORTUNITY_BASE_FIELDS)
+
+# Opportunity names that mark a Price Reset, matched in one pass over the lowercased name
+PRICE_RESET_NAME_RE = re.compile(r'price[ -]reset')
+
+# Follow-up check queries, URL-encoded once; values are filled in with soql_value
+SUBSCRIPTION_QUERY = encoded_soql_template(
+    "SELECT Id, Name, SBQQ__Contract__c FROM SBQQ__Subscription__c WHERE Id = '{}' LIMIT 1"
+)
+QUOTE_QUERY = encoded_soql_template("""
+    SELECT Id, Name, SBQQ__Status__c, SBQQ__NetAmount__c, SBQQ__StartDate__c, SBQQ__EndDate__c
+    FROM SBQQ__Quote__c
+    WHERE SBQQ__Opportunity2__c = '{}'
+    ORDER BY CreatedDate DESC
+""")
+UPSELL_QUERY = encoded_soql_template("""
+    SELECT Id, Name, Amount, StageName, Type, CloseDate
+    FROM Opportunity
+    WHERE AccountId = '{}'
+    AND Id != '{}'
+    AND (Type LIKE '%Upsell%' OR Type LIKE '%Expansion%' OR Type LIKE '%Add-on%')
+    AND IsClosed = false
+    ORDER BY CloseDate DESC
+    LIMIT 10
+""")
+
+
+def soql_value(value):
+    """Escape a value for a quoted SOQL string literal and URL-encode it."""
+    escaped = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    return urllib.parse.quote(escaped, safe='')
+
+
+def salesforce_get(access_token, instance_url, endpoint, retry_auth=True):
+    """Make a GET request to Salesforce, re-authenticating once on an expired token."""
+    url = instance_url + API_PATH + endpoint
+    headers = api_headers(access_token)
     
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+    status, raw = http_request('GET', url, headers=headers)
     
-    req = urllib.request.Request(url, headers=headers, method='GET')
+    if status == 404:
+        return None
+    if status == 401 and retry_auth:
+        invalidate_access_token(access_token)
+        access_token, instance_url = get_access_token()
+        return salesforce_get(access_token, instance_url, endpoint, retry_auth=False)
+    if status >= 400:
+        raise Exception(f"Salesforce API error: {status} - {raw.decode('utf-8')}")
+    return json.loads(raw)
+
+
+def salesforce_batch_query(access_token, instance_url, queries):
+    """
+    Run several SOQL queries in one Composite Batch round-trip.
     
+    Takes a dict of name -> URL-encoded SOQL and returns a dict of name -> query result.
+    A query that fails maps to an Exception instead, so callers can handle
+    each failure on its own; see batch_result.
+    """
+    names = list(queries)
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            return None
-        error_body = e.read().decode('utf-8')
-        raise Exception(f"Salesforce API error: {e.code} - {error_body}")
+        result = salesforce_api_call(
+            method='POST',
+            endpoint='/composite/batch',
+            access_token=access_token,
+            instance_url=instance_url,
+            data={
+                'batchRequests': [
+                    {'method': 'GET', 'url': BATCH_QUERY_URL + queries[name]}
+                    for name in names
+                ]
+            }
+        )
+    except Exception as e:
+        return {name: e for name in names}
+    
+    results = {}
+    for name, sub in zip(names, result.get('results', [])):
+        status = sub.get('statusCode', 500)
+        if status >= 400:
+            results[name] = Exception(f"SOQL query error: {status} - {json.dumps(sub.get('result'))}")
+        else:
+            results[name] = sub.get('result')
+    return results
+
+
+def batch_result(results, name):
+    """Return one query's result from salesforce_batch_query, raising its error if it failed."""
+    entry = results.get(name)
+    if isinstance(entry, Exception):
+        raise entry
+    return entry
 
 
 def describe_object(access_token, instance_url, object_name):
@@ -81,87 +144,102 @@ def describe_object(access_token, instance_url, object_name):
 
 
 def get_opportunity_fields(access_token, instance_url):
-    """Get all field names for Opportunity object."""
+    """Get the set of field names for Opportunity object, cached for DESCRIBE_CACHE_TTL seconds."""
+    cached = _DESCRIBE_CACHE.get('Opportunity')
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
     describe = describe_object(access_token, instance_url, "Opportunity")
     if describe:
-        return [field['name'] for field in describe.get('fields', [])]
-    return []
+        fields = frozenset(field['name'] for field in describe.get('fields', []))
+        _DESCRIBE_CACHE['Opportunity'] = (time.monotonic() + DESCRIBE_CACHE_TTL, fields)
+        return fields
+    return frozenset()
+
+
+def get_custom_fields(access_token, instance_url):
+    """
+    Map each CUSTOM_FIELD_MAPPINGS key to the first of its names that exists on
+    Opportunity, cached for DESCRIBE_CACHE_TTL seconds. The returned dict is
+    shared between calls and must not be modified.
+    """
+    cached = _DESCRIBE_CACHE.get('Opportunity.custom_fields')
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    opp_fields = get_opportunity_fields(access_token, instance_url)
+    
+    found_fields = {}
+    for field_key, possible_names in CUSTOM_FIELD_MAPPINGS.items():
+        field_name = next((name for name in possible_names if name in opp_fields), None)
+        if field_name:
+            found_fields[field_key] = field_name
+    
+    # An empty field set means the describe failed; don't cache that
+    if opp_fields:
+        _DESCRIBE_CACHE['Opportunity.custom_fields'] = (time.monotonic() + DESCRIBE_CACHE_TTL, found_fields)
+    return found_fields
+
+
+@dataclass(slots=True)
+class CheckResult:
+    name: str
+    status: str  # 'PASS', 'FAIL', 'WARNING', 'SKIP', 'INFO'
+    message: str
+    details: dict | None = None
+    
+    def to_dict(self):
+        check = {'name': self.name, 'status': self.status, 'message': self.message}
+        if self.details:
+            check['details'] = self.details
+        return check
 
 
 class ValidationResult:
     def __init__(self):
         self.checks = []
         self.has_issues = False
+        self.status_counts = {'PASS': 0, 'FAIL': 0, 'WARNING': 0, 'SKIP': 0, 'INFO': 0}
     
     def add_check(self, name, status, message, details=None):
         """Add a validation check result."""
-        check = {
-            'name': name,
-            'status': status,  # 'PASS', 'FAIL', 'WARNING', 'SKIP', 'INFO'
-            'message': message
-        }
-        if details:
-            check['details'] = details
-        
-        self.checks.append(check)
+        self.checks.append(CheckResult(name, status, message, details))
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
         
-        if status in ['FAIL', 'WARNING']:
+        if status == 'FAIL' or status == 'WARNING':
             self.has_issues = True
     
     def to_dict(self):
         return {
             'overall_status': 'ISSUES FOUND' if self.has_issues else 'ALL GOOD',
             'total_checks': len(self.checks),
-            'passed': len([c for c in self.checks if c['status'] == 'PASS']),
-            'failed': len([c for c in self.checks if c['status'] == 'FAIL']),
-            'warnings': len([c for c in self.checks if c['status'] == 'WARNING']),
-            'skipped': len([c for c in self.checks if c['status'] == 'SKIP']),
-            'checks': self.checks
+            'passed': self.status_counts['PASS'],
+            'failed': self.status_counts['FAIL'],
+            'warnings': self.status_counts['WARNING'],
+            'skipped': self.status_counts['SKIP'],
+            'checks': [check.to_dict() for check in self.checks]
         }
 
 
+@functools.lru_cache(maxsize=None)
+def opportunity_query_template(custom_fields):
+    """URL-encoded Opportunity query for the base fields plus the given custom fields."""
+    fields = ', '.join((OPPORTUNITY_BASE_FIELDS_CSV,) + custom_fields)
+    return encoded_soql_template(f"SELECT {fields} FROM Opportunity WHERE Id = '{{}}'")
+
+
 def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
     """Validate a renewal opportunity against all criteria."""
     
     result = ValidationResult()
     
-    # First, get the Opportunity fields available
-    opp_fields = get_opportunity_fields(access_token, instance_url)
+    # First, find which custom fields actually exist on Opportunity
+    found_fields = get_custom_fields(access_token, instance_url)
     
-    # Build dynamic query based on available fields
-    # Standard fields we always query
-    base_fields = ['Id', 'Name', 'StageName', 'AccountId', 'Amount', 'CloseDate', 'Type', 'IsClosed', 'IsWon']
-    
-    # Custom fields we're looking for (with various possible naming conventions)
-    custom_field_mappings = {
-        'netsuite_id': ['NetSuite_ID__c', 'NetSuiteID__c', 'Netsuite_Id__c', 'NS_ID__c', 'NetSuite_Internal_ID__c'],
-        'parent_sub_id': ['Parent_Subscription_ID__c', 'Parent_Sub_ID__c', 'ParentSubscriptionId__c', 'Parent_Subscription__c'],
-        'price_reset': ['Price_Reset__c', 'Is_Price_Reset__c', 'PriceReset__c'],
-        'auto_renewed_last_term': ['Auto_Renewed_Last_Term__c', 'AutoRenewedLastTerm__c', 'Auto_Renewal_Last_Term__c'],
-        'cancelled_before_renewal': ['Cancelled_before_Renewal_Cycle__c', 'Cancelled_Before_Renewal__c', 'CancelledBeforeRenewal__c'],
-        'cancellation_notice': ['Cancellation_Notice__c', 'CancellationNotice__c', 'Cancellation_Notice_Link__c'],
-        'auto_renewal_clause': ['Auto_Renewal_Clause__c', 'AutoRenewalClause__c', 'AR_Clause__c'],
-        'prev_quote_ar_clause': ['Prev_Quote_w_AR_Clause__c', 'Previous_Quote_AR_Clause__c', 'Prev_Quote_AR__c'],
-        'o2c_processed': ['O2C_Processed__c', 'Processed_via_O2C__c', 'O2C__c'],
-        'subscription_id': ['SBQQ__RenewedContract__c', 'Subscription__c', 'Subscription_ID__c', 'CPQ_Subscription__c'],
-        'previous_quote': ['Previous_Quote__c', 'Prev_Quote__c', 'Prior_Quote__c', 'SBQQ__RenewedQuote__c'],
-    }
-    
-    # Find which custom fields actually exist
-    found_fields = {}
-    for field_key, possible_names in custom_field_mappings.items():
-        for field_name in possible_names:
-            if field_name in opp_fields:
-                found_fields[field_key] = field_name
-                break
-    
-    # Build query with available fields
-    query_fields = base_fields.copy()
-    query_fields.extend(found_fields.values())
-    
-    # Query the Opportunity
-    opp_query = f"SELECT {', '.join(query_fields)} FROM Opportunity WHERE Id = '{opportunity_id}'"
-    opp_result = salesforce_query(access_token, instance_url, opp_query)
+    # Query the Opportunity with the base fields plus the custom fields that exist;
+    # the encoded query is built once per field set
+    opp_query = opportunity_query_template(tuple(found_fields.values()))
+    opp_result = salesforce_encoded_query(access_token, instance_url, opp_query.format(soql_value(opportunity_id)))
     
     if not opp_result.get('records'):
         result.add_check("Opportunity Exists", "FAIL", f"Opportunity {opportunity_id} not found")
@@ -175,6 +253,24 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         'Close Date': opp.get('CloseDate')
     })
     
+    # Checks 2-4 each need one more query and none depends on another,
+    # so send them as one batch before working through the checks in order
+    parent_sub_field = found_fields.get('parent_sub_id')
+    parent_sub_id = opp.get(parent_sub_field) if parent_sub_field else None
+    account_id = opp.get('AccountId')
+    
+    follow_up_queries = {}
+    if parent_sub_id:
+        follow_up_queries['subscription'] = SUBSCRIPTION_QUERY.format(soql_value(parent_sub_id))
+    
+    # Query for quotes related to this opportunity
+    follow_up_queries['quotes'] = QUOTE_QUERY.format(soql_value(opportunity_id))
+    
+    if account_id:
+        follow_up_queries['upsells'] = UPSELL_QUERY.format(soql_value(account_id), soql_value(opportunity_id))
+    
+    follow_up = salesforce_batch_query(access_token, instance_url, follow_up_queries)
+    
     # ============================================
     # CHECK 1: NetSuite ID (if O2C processed)
     # ============================================
@@ -204,7 +300,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
                 result.add_check(
                     "O2C - NetSuite ID", 
                     "WARNING", 
-                    f"NetSuite ID field not found. Looked for: {custom_field_mappings['netsuite_id']}"
+                    f"NetSuite ID field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['netsuite_id']}"
                 )
         else:
             result.add_check("O2C - NetSuite ID", "SKIP", "Not processed via O2C")
@@ -212,21 +308,17 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "O2C - NetSuite ID", 
             "SKIP", 
-            f"O2C field not found. Looked for: {custom_field_mappings['o2c_processed']}"
+            f"O2C field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['o2c_processed']}"
         )
     
     # ============================================
     # CHECK 2: Parent Subscription ID
     # ============================================
-    parent_sub_field = found_fields.get('parent_sub_id')
-    
     if parent_sub_field:
-        parent_sub_id = opp.get(parent_sub_field)
         if parent_sub_id:
             # Try to validate the subscription exists
-            sub_query = f"SELECT Id, Name, SBQQ__Contract__c FROM SBQQ__Subscription__c WHERE Id = '{parent_sub_id}' LIMIT 1"
             try:
-                sub_result = salesforce_query(access_token, instance_url, sub_query)
+                sub_result = batch_result(follow_up, 'subscription')
                 if sub_result.get('records'):
                     sub = sub_result['records'][0]
                     result.add_check(
@@ -258,23 +350,14 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "Parent Subscription ID", 
             "WARNING", 
-            f"Parent Sub ID field not found. Looked for: {custom_field_mappings['parent_sub_id']}"
+            f"Parent Sub ID field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['parent_sub_id']}"
         )
     
     # ============================================
     # CHECK 3: Validate Renewal Data Against Signed Quote
     # ============================================
-    prev_quote_field = found_fields.get('previous_quote')
-    
-    # Query for quotes related to this opportunity
-    quote_query = f"""
-        SELECT Id, Name, SBQQ__Status__c, SBQQ__NetAmount__c, SBQQ__StartDate__c, SBQQ__EndDate__c 
-        FROM SBQQ__Quote__c 
-        WHERE SBQQ__Opportunity2__c = '{opportunity_id}' 
-        ORDER BY CreatedDate DESC
-    """
     try:
-        quotes_result = salesforce_query(access_token, instance_url, quote_query)
+        quotes_result = batch_result(follow_up, 'quotes')
         quotes = quotes_result.get('records', [])
         
         if quotes:
@@ -339,20 +422,9 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
     # ============================================
     # CHECK 4: Upsells in Current Term
     # ============================================
-    account_id = opp.get('AccountId')
     if account_id:
-        upsell_query = f"""
-            SELECT Id, Name, Amount, StageName, Type, CloseDate 
-            FROM Opportunity 
-            WHERE AccountId = '{account_id}' 
-            AND Id != '{opportunity_id}'
-            AND (Type LIKE '%Upsell%' OR Type LIKE '%Expansion%' OR Type LIKE '%Add-on%')
-            AND IsClosed = false
-            ORDER BY CloseDate DESC
-            LIMIT 10
-        """
         try:
-            upsell_result = salesforce_query(access_token, instance_url, upsell_query)
+            upsell_result = batch_result(follow_up, 'upsells')
             upsells = upsell_result.get('records', [])
             
             if upsells:
@@ -391,7 +463,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
     
     # Check if this looks like a price reset opp (by name or type)
     opp_name = opp.get('Name', '').lower()
-    is_likely_price_reset = 'price reset' in opp_name or 'price-reset' in opp_name
+    is_likely_price_reset = PRICE_RESET_NAME_RE.search(opp_name) is not None
     
     if price_reset_field:
         price_reset_checked = opp.get(price_reset_field)
@@ -426,7 +498,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "Price Reset Checkbox",
             "SKIP",
-            f"Price Reset field not found. Looked for: {custom_field_mappings['price_reset']}"
+            f"Price Reset field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['price_reset']}"
         )
     
     # ============================================
@@ -446,7 +518,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "Auto-Renewed Last Term",
             "SKIP",
-            f"Field not found. Looked for: {custom_field_mappings['auto_renewed_last_term']}"
+            f"Field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['auto_renewed_last_term']}"
         )
     
     # ============================================
@@ -502,7 +574,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "Cancellation Handling",
             "SKIP",
-            f"Cancellation field not found. Looked for: {custom_field_mappings['cancelled_before_renewal']}"
+            f"Cancellation field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['cancelled_before_renewal']}"
         )
     
     # ============================================
@@ -550,7 +622,7 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
         result.add_check(
             "Auto-Renewal Clause",
             "SKIP",
-            f"AR Clause field not found. Looked for: {custom_field_mappings['auto_renewal_clause']}"
+            f"AR Clause field not found. Looked for: {CUSTOM_FIELD_MAPPINGS['auto_renewal_clause']}"
         )
     
     # ============================================
@@ -559,10 +631,10 @@ def validate_renewal_opportunity(access_token, instance_url, opportunity_id):
     result.add_check(
         "Field Discovery",
         "INFO",
-        f"Found {len(found_fields)} of {len(custom_field_mappings)} expected custom fields",
+        f"Found {len(found_fields)} of {len(CUSTOM_FIELD_MAPPINGS)} expected custom fields",
         {
             "Found_Fields": found_fields,
-            "Missing_Fields": [k for k in custom_field_mappings.keys() if k not in found_fields]
+            "Missing_Fields": [k for k in CUSTOM_FIELD_MAPPINGS.keys() if k not in found_fields]
         }
     )
     
@@ -606,6 +678,15 @@ def lambda_handler(event, context):
                 })
             }
         
+        if not isinstance(opportunity_id, str) or not SALESFORCE_ID_PATTERN.fullmatch(opportunity_id):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'success': False,
+                    'error': 'opportunity_id must be a 15 or 18 character Salesforce ID'
+                })
+            }
+        
         # Get access token
         access_token, instance_url = get_access_token()
         
@@ -618,7 +699,7 @@ def lambda_handler(event, context):
                 'success': True,
                 'opportunity_id': opportunity_id,
                 'validation': validation_result.to_dict()
-            }, indent=2)
+            }, **RESPONSE_JSON_OPTIONS)
         }
         
     except Exception as e:
@@ -638,5 +719,5 @@ if __name__ == "__main__":
     }
     
     result = lambda_handler(test_event, None)
-    print(result['body'])
+    print(json.dumps(json.loads(result['body']), indent=2))
 